@@ -1415,7 +1415,7 @@ def get_memory_history():
         
         return jsonify({
             "success": True,
-            "history": history,
+            "history": [message.to_dict() for message in history],
             "total_messages": len(history)
         })
     except Exception as e:
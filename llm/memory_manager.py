@@ -1,70 +1,201 @@
 # llm/memory_manager.py
 import json
 import logging
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import islice, zip_longest
 from typing import Dict, List, Any
 import hashlib
+import re
+import sys
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+# Message roles; stored roles are interned so equality checks hit the identity fast path
+_ROLE_USER = sys.intern('user')
+_ROLE_ASSISTANT = sys.intern('assistant')
+
+# Minimum age of last_accessed before a read refreshes it
+_TOUCH_INTERVAL_SECONDS = 1.0
+
+# Keywords inspected by _analyze_history, matched against lowercased SQL
+_SQL_KEYWORD_RE = re.compile(r'count\(|sum\(|avg\(|max\(|min\(|where')
+_AGGREGATE_KEYWORDS = frozenset({'sum(', 'avg(', 'max(', 'min('})
+# First (possibly schema-qualified) table name after FROM, matched against lowercased SQL.
+# Each name part may be bare or quoted MySQL-style (`a`), ANSI-style ("a") or SQL Server-style ([a]).
+_TABLE_PART = r'(?:`[^`]+`|"[^"]+"|\[[^\]]+\]|[\w#$@]+)'
+_FROM_TABLE_RE = re.compile(rf'\bfrom\s+({_TABLE_PART}(?:\.{_TABLE_PART})*)')
+_IDENTIFIER_QUOTES = str.maketrans('', '', '`"[]')
+
+@lru_cache(maxsize=1024)
+def _conversation_key(session_id: str, database: str) -> str:
+    """Hash a session/database pair, memoized since the same pair repeats across calls"""
+    key_string = f"{session_id}\0{database}"
+    return hashlib.blake2b(key_string.encode(), digest_size=8).hexdigest()
+
+class Message:
+    """A single conversation message; slotted to keep per-message memory low"""
+    __slots__ = ('role', 'content', 'timestamp', 'ts', 'hour', 'sql_query', 'sql_query_lower', 'results_summary')
+    
+    def __init__(self, role: str, content: str, timestamp: str, ts: float, hour: int,
+                 sql_query: str = None, results_summary: Dict = None):
+        self.role = role
+        self.content = content
+        self.timestamp = timestamp
+        self.ts = ts
+        self.hour = hour
+        self.sql_query = sql_query
+        # Normalized once here so history analysis never re-lowercases the SQL
+        self.sql_query_lower = sql_query.lower() if sql_query else None
+        self.results_summary = results_summary
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Serializable form used by the API"""
+        return {
+            'role': self.role,
+            'content': self.content,
+            'timestamp': self.timestamp,
+            'sql_query': self.sql_query,
+            'results_summary': self.results_summary
+        }
+
 class MemoryManager:
     def __init__(self, max_conversations=10, max_messages_per_conversation=20):
-        self.memory_store = {}
+        self.memory_store = OrderedDict()
         self.max_conversations = max_conversations
         self.max_messages_per_conversation = max_messages_per_conversation
+        # Guards structural changes to memory_store (insert, reorder, evict, delete).
+        # Per-conversation deque appends and list() snapshots are atomic under the GIL.
+        self._lock = threading.Lock()
     
     def _get_conversation_key(self, session_id: str, database: str) -> str:
         """Generate a unique key for conversation"""
-        key_string = f"{session_id}_{database}"
-        return hashlib.md5(key_string.encode()).hexdigest()
+        # session_id comes straight from request JSON and may not be a hashable str
+        return _conversation_key(str(session_id), str(database))
     
     def add_message(self, session_id: str, database: str, role: str, content: str, 
                    sql_query: str = None, results_summary: Dict = None):
         """Add a message to conversation history"""
         conv_key = self._get_conversation_key(session_id, database)
+        now_ts = time.time()
+        now_dt = datetime.utcfromtimestamp(now_ts)
+        now_iso = now_dt.isoformat()
         
-        if conv_key not in self.memory_store:
-            self.memory_store[conv_key] = {
-                'session_id': session_id,
-                'database': database,
-                'messages': [],
-                'created_at': datetime.utcnow().isoformat(),
-                'last_accessed': datetime.utcnow().isoformat()
-            }
-        
-        message = {
-            'role': role,
-            'content': content,
-            'timestamp': datetime.utcnow().isoformat(),
-            'sql_query': sql_query,
-            'results_summary': results_summary
-        }
+        message = Message(sys.intern(role), content, now_iso, now_ts, now_dt.hour, sql_query, results_summary)
+        oldest_key = None
         
-        self.memory_store[conv_key]['messages'].append(message)
-        self.memory_store[conv_key]['last_accessed'] = datetime.utcnow().isoformat()
+        with self._lock:
+            conversation = self.memory_store.get(conv_key)
+            if conversation is None:
+                conversation = {
+                    'session_id': session_id,
+                    'database': database,
+                    'messages': deque(maxlen=self.max_messages_per_conversation),
+                    'created_at': now_iso,
+                    'last_accessed': now_iso,
+                    'last_accessed_ts': now_ts
+                }
+                self.memory_store[conv_key] = conversation
+            else:
+                self.memory_store.move_to_end(conv_key)
+            
+            # Evict the least recently used conversation once over capacity
+            if len(self.memory_store) > self.max_conversations:
+                oldest_key, _ = self.memory_store.popitem(last=False)
         
-        # Limit messages per conversation
-        if len(self.memory_store[conv_key]['messages']) > self.max_messages_per_conversation:
-            self.memory_store[conv_key]['messages'] = self.memory_store[conv_key]['messages'][-self.max_messages_per_conversation:]
+        if oldest_key is not None:
+            logger.info(f"Cleaned up old conversation: {oldest_key}")
         
-        # Clean up old conversations
-        self._cleanup_old_conversations()
+        conversation['messages'].append(message)
+        conversation['last_accessed'] = now_iso
+        conversation['last_accessed_ts'] = now_ts
         
-        logger.info(f"Added message to conversation {conv_key}. Total messages: {len(self.memory_store[conv_key]['messages'])}")
+        logger.info(f"Added message to conversation {conv_key}. Total messages: {len(conversation['messages'])}")
     
-    def get_conversation_history(self, session_id: str, database: str, max_messages: int = 10) -> List[Dict]:
+    def get_conversation_history(self, session_id: str, database: str, max_messages: int = 10) -> List[Message]:
         """Get recent conversation history"""
         conv_key = self._get_conversation_key(session_id, database)
-        
-        if conv_key not in self.memory_store:
+        self._touch(conv_key)
+        return self._get_history(conv_key, max_messages)
+    
+    def _get_history(self, conv_key: str, max_messages: int = 10) -> List[Message]:
+        """Return recent messages without updating access bookkeeping"""
+        conversation = self.memory_store.get(conv_key)
+        if conversation is None:
             return []
         
-        # Update last accessed time
-        self.memory_store[conv_key]['last_accessed'] = datetime.utcnow().isoformat()
-        
         # Return recent messages (limit to max_messages)
-        messages = self.memory_store[conv_key]['messages']
-        return messages[-max_messages:] if max_messages else messages
+        messages = conversation['messages']
+        # list() copies the deque atomically; islice over a deque that another
+        # thread appends to would raise "deque mutated during iteration"
+        snapshot = list(messages)
+        if not max_messages or len(snapshot) <= max_messages:
+            return snapshot
+        return snapshot[-max_messages:]
+    
+    def _touch(self, conv_key: str):
+        """Mark a conversation as recently used"""
+        with self._lock:
+            conversation = self.memory_store.get(conv_key)
+            if conversation is None:
+                return
+            self.memory_store.move_to_end(conv_key)
+        
+        # Only re-format the access time when it has moved by at least a second
+        now_ts = time.time()
+        if now_ts - conversation['last_accessed_ts'] >= _TOUCH_INTERVAL_SECONDS:
+            conversation['last_accessed'] = datetime.utcfromtimestamp(now_ts).isoformat()
+            conversation['last_accessed_ts'] = now_ts
+    
+    def _analyze_history(self, history: List[Message]) -> Dict[str, Any]:
+        """Derive schema and query-pattern data in a single pass over history"""
+        learned_tables = set()
+        table_usage = {}
+        query_types = {
+            'SELECT': 0,
+            'COUNT': 0,
+            'AGGREGATE': 0,
+            'FILTER': 0
+        }
+        total_interactions = 0
+        
+        for message in history:
+            if message.role == _ROLE_USER:
+                total_interactions += 1
+            
+            if not message.sql_query:
+                continue
+            
+            sql = message.sql_query_lower
+            keywords = set(_SQL_KEYWORD_RE.findall(sql))
+            
+            # Count query types
+            if 'count(' in keywords:
+                query_types['COUNT'] += 1
+            if keywords & _AGGREGATE_KEYWORDS:
+                query_types['AGGREGATE'] += 1
+            if 'where' in keywords:
+                query_types['FILTER'] += 1
+            query_types['SELECT'] += 1
+            
+            # Extract table names (simple pattern matching)
+            table_match = _FROM_TABLE_RE.search(sql)
+            if table_match:
+                table_part = table_match.group(1).translate(_IDENTIFIER_QUOTES)
+                table_key = table_part.upper()
+                table_usage[table_key] = table_usage.get(table_key, 0) + 1
+                if len(table_part) < 50:  # Basic validation
+                    learned_tables.add(table_part)
+        
+        return {
+            'tables': learned_tables,
+            'table_usage': table_usage,
+            'query_types': query_types,
+            'total_interactions': total_interactions
+        }
     
     def get_conversation_summary(self, session_id: str, database: str) -> str:
         """Get a natural language summary of the conversation"""
@@ -73,84 +204,43 @@ class MemoryManager:
         if not history:
             return "No previous conversation history."
         
-        summary = "Previous conversation context:\n"
+        lines = ["Previous conversation context:"]
         
-        for i, message in enumerate(history[-3:], 1):  # Last 3 messages
-            if message['role'] == 'user':
-                summary += f"User asked: {message['content']}\n"
-                if message.get('sql_query'):
-                    summary += f"SQL used: {message['sql_query']}\n"
-            elif message['role'] == 'assistant':
-                if message.get('results_summary'):
-                    results = message['results_summary']
-                    summary += f"Found {results.get('row_count', 0)} rows with columns: {', '.join(results.get('columns', []))}\n"
+        for message in history[-3:]:  # Last 3 messages
+            if message.role == _ROLE_USER:
+                lines.append(f"User asked: {message.content}")
+                if message.sql_query:
+                    lines.append(f"SQL used: {message.sql_query}")
+            elif message.role == _ROLE_ASSISTANT:
+                if message.results_summary:
+                    results = message.results_summary
+                    lines.append(f"Found {results.get('row_count', 0)} rows with columns: {', '.join(results.get('columns', []))}")
         
-        return summary
+        return "\n".join(lines) + "\n"
     
     def get_schema_learning(self, session_id: str, database: str) -> Dict[str, Any]:
         """Extract learned schema patterns from conversation history"""
         history = self.get_conversation_history(session_id, database)
-        
-        learned_tables = set()
-        learned_columns = {}
-        common_filters = {}
-        
-        for message in history:
-            if message.get('sql_query'):
-                sql = message['sql_query'].lower()
-                
-                # Extract table names (simple pattern matching)
-                if 'from' in sql:
-                    # Simple table extraction - can be enhanced
-                    parts = sql.split('from')
-                    if len(parts) > 1:
-                        table_part = parts[1].split()[0].strip('`')
-                        if table_part and len(table_part) < 50:  # Basic validation
-                            learned_tables.add(table_part)
-                
-                # Extract column patterns from user queries
-                if message['role'] == 'user':
-                    content_lower = message['content'].lower()
-                    # Look for column mentions
-                    column_indicators = ['column', 'field', 'show me', 'find', 'filter by', 'where']
-                    for indicator in column_indicators:
-                        if indicator in content_lower:
-                            # Simple extraction - can be enhanced with NLP
-                            pass
+        analysis = self._analyze_history(history)
         
         return {
-            'tables': list(learned_tables),
-            'columns': learned_columns,
-            'common_filters': common_filters
+            'tables': list(analysis['tables']),
+            'columns': {},
+            'common_filters': {}
         }
     
-    def _cleanup_old_conversations(self):
-        """Remove old conversations to manage memory"""
-        if len(self.memory_store) <= self.max_conversations:
-            return
-        
-        # Sort by last accessed time and remove oldest
-        conversations = sorted(
-            self.memory_store.items(),
-            key=lambda x: x[1]['last_accessed']
-        )
-        
-        # Remove oldest conversations until we're under the limit
-        while len(self.memory_store) > self.max_conversations:
-            oldest_key = conversations.pop(0)[0]
-            del self.memory_store[oldest_key]
-            logger.info(f"Cleaned up old conversation: {oldest_key}")
-    
     def clear_conversation(self, session_id: str, database: str):
         """Clear specific conversation history"""
         conv_key = self._get_conversation_key(session_id, database)
-        if conv_key in self.memory_store:
-            del self.memory_store[conv_key]
+        with self._lock:
+            conversation = self.memory_store.pop(conv_key, None)
+        if conversation is not None:
             logger.info(f"Cleared conversation: {conv_key}")
     
     def clear_all_conversations(self):
         """Clear all conversation history"""
-        self.memory_store.clear()
+        with self._lock:
+            self.memory_store.clear()
         logger.info("Cleared all conversation history")
 
     # NEW ENHANCED METHODS FOR BETTER MEMORY MANAGEMENT
@@ -163,33 +253,36 @@ class MemoryManager:
         total_queries = 0
         total_rows = 0
         
-        for i, message in enumerate(history):
-            if message['role'] == 'user':
-                # This is a user query
-                history_item = {
-                    'type': 'query',
-                    'timestamp': message['timestamp'],
-                    'content': message['content'],
-                    'sql_query': None,
-                    'results': None,
-                    'message_id': i
-                }
-                
-                # Look ahead for assistant response
-                if i + 1 < len(history) and history[i + 1]['role'] == 'assistant':
-                    assistant_msg = history[i + 1]
-                    history_item['sql_query'] = assistant_msg.get('sql_query')
-                    if assistant_msg.get('results_summary'):
-                        results = assistant_msg['results_summary']
-                        history_item['results'] = {
-                            'row_count': results.get('row_count', 0),
-                            'columns': results.get('columns', []),
-                            'execution_time': results.get('execution_time', 0)
-                        }
-                        total_queries += 1
-                        total_rows += results.get('row_count', 0)
-                
-                formatted_history.append(history_item)
+        # Pair each message with the one that follows it (None after the last)
+        next_messages = islice(history, 1, None)
+        for i, (message, next_message) in enumerate(zip_longest(history, next_messages)):
+            if message.role != _ROLE_USER:
+                continue
+            
+            # This is a user query, answered by the following assistant message if any
+            sql_query = None
+            formatted_results = None
+            if next_message is not None and next_message.role == _ROLE_ASSISTANT:
+                sql_query = next_message.sql_query
+                results = next_message.results_summary
+                if results:
+                    row_count = results.get('row_count', 0)
+                    formatted_results = {
+                        'row_count': row_count,
+                        'columns': results.get('columns', []),
+                        'execution_time': results.get('execution_time', 0)
+                    }
+                    total_queries += 1
+                    total_rows += row_count
+            
+            formatted_history.append({
+                'type': 'query',
+                'timestamp': message.timestamp,
+                'content': message.content,
+                'sql_query': sql_query,
+                'results': formatted_results,
+                'message_id': i
+            })
         
         return {
             'conversations': formatted_history,
@@ -200,16 +293,13 @@ class MemoryManager:
             }
         }
 
-    def _calculate_session_duration(self, history: List[Dict]) -> str:
+    def _calculate_session_duration(self, history: List[Message]) -> str:
         """Calculate session duration from first to last message"""
         if not history:
             return "0 minutes"
         
         try:
-            first_time = datetime.fromisoformat(history[0]['timestamp'])
-            last_time = datetime.fromisoformat(history[-1]['timestamp'])
-            duration = last_time - first_time
-            minutes = duration.total_seconds() / 60
+            minutes = (history[-1].ts - history[0].ts) / 60
             
             if minutes < 1:
                 return "Less than 1 minute"
@@ -225,51 +315,22 @@ class MemoryManager:
         """Get insights about the conversation patterns"""
         history = self.get_conversation_history(session_id, database)
         
-        # Analyze query patterns
-        table_usage = {}
-        common_filters = {}
-        query_types = {
-            'SELECT': 0,
-            'COUNT': 0,
-            'AGGREGATE': 0,
-            'FILTER': 0
-        }
-        
-        for message in history:
-            if message.get('sql_query'):
-                sql = message['sql_query'].upper()
-                
-                # Count query types
-                if 'COUNT(' in sql:
-                    query_types['COUNT'] += 1
-                if any(agg in sql for agg in ['SUM(', 'AVG(', 'MAX(', 'MIN(']):
-                    query_types['AGGREGATE'] += 1
-                if 'WHERE' in sql:
-                    query_types['FILTER'] += 1
-                query_types['SELECT'] += 1
-                
-                # Extract table usage
-                if 'FROM' in sql:
-                    table_part = sql.split('FROM')[1].split()[0].strip('`')
-                    table_usage[table_part] = table_usage.get(table_part, 0) + 1
+        analysis = self._analyze_history(history)
         
         return {
-            'query_patterns': query_types,
-            'table_usage': table_usage,
-            'total_interactions': len([m for m in history if m['role'] == 'user']),
+            'query_patterns': analysis['query_types'],
+            'table_usage': analysis['table_usage'],
+            'total_interactions': analysis['total_interactions'],
             'most_active_period': self._get_most_active_period(history)
         }
 
-    def _get_most_active_period(self, history: List[Dict]) -> str:
+    def _get_most_active_period(self, history: List[Message]) -> str:
         """Determine the most active period in the conversation"""
         if not history:
             return "No activity"
         
         try:
-            hours = []
-            for message in history:
-                dt = datetime.fromisoformat(message['timestamp'])
-                hours.append(dt.hour)
+            hours = [message.hour for message in history]
             
             if hours:
                 avg_hour = sum(hours) / len(hours)